@@ -0,0 +1,19 @@
+# --- gunicorn.conf.py (production server config) ---
+#
+# Run with: gunicorn -c gunicorn.conf.py webhook_server:app
+#
+# The app is ASGI (Quart), so each worker is a Uvicorn event loop:
+# long Supabase round-trips yield the loop instead of monopolizing a worker.
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = 2 * multiprocessing.cpu_count() + 1
+worker_connections = 1000
+
+# Recycle workers periodically so a slow leak can't grow forever
+max_requests = 10000
+max_requests_jitter = 1000
@@ -0,0 +1,12 @@
+-- Index clients.contact_email so the Stripe webhook's
+-- UPDATE ... WHERE contact_email = $1 is an index lookup instead of a
+-- sequential scan that grows with the client count. UNIQUE also blocks
+-- duplicate signup rows from Typeform webhook retries.
+--
+-- Note: no CONCURRENTLY here - Supabase CLI migrations run inside a
+-- transaction, which CONCURRENTLY forbids. The clients table is small
+-- enough that the brief write lock is fine; if it ever isn't, run
+-- CREATE UNIQUE INDEX CONCURRENTLY by hand instead.
+
+CREATE UNIQUE INDEX IF NOT EXISTS clients_contact_email_idx
+    ON clients (contact_email);
@@ -1,28 +1,192 @@
 # --- webhook_server.py (PRODUCTION VERSION - Never Sleeps) ---
 
-from flask import Flask, request, jsonify
+from quart import Quart, request, jsonify
+from quart.json.provider import JSONProvider
+import asyncio
+import logging
 import os
-from supabase import create_client
+import traceback
+import fastjsonschema
+import httpx
+import orjson
+import stripe
+from cachetools import TTLCache
+from supabase import acreate_client
+from werkzeug.exceptions import HTTPException
 
-app = Flask(__name__)
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson - same bytes, 2-5x less parse/dump CPU."""
+
+    def dumps(self, object_, **kwargs):
+        return orjson.dumps(object_).decode()
+
+    def loads(self, object_, **kwargs):
+        return orjson.loads(object_)
+
+app = Quart(__name__)
+app.json = ORJSONProvider(app)
+
+# Reject oversized bodies with 413 - Quart raises RequestEntityTooLarge
+# when a handler awaits the body, so the handlers re-raise HTTPException
+# rather than swallowing it into a 500. Real Typeform/Stripe payloads are
+# a few KB, so a malicious 100MB POST never gets buffered into memory
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
+
+# Structured logger with lazy %s formatting - when a record is filtered the
+# args are never formatted, so setting LOG_LEVEL=WARNING in production makes
+# the info-level request paths free (and avoids stdout lock contention
+# across workers, unlike print)
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
+logger = logging.getLogger('webhook')
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
 
 # Get environment variables
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_KEY')
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 
-# Initialize Supabase (do this once at startup, not per request)
+# Async Supabase client - created once when the event loop starts, shared by
+# every in-flight request (one loop can multiplex hundreds of Supabase calls)
 supabase = None
-try:
-    if SUPABASE_URL and SUPABASE_SERVICE_KEY:
-        supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-        print("✅ Supabase client initialized successfully")
-    else:
-        print("❌ ERROR: Supabase credentials missing")
-except Exception as e:
-    print(f"❌ CRITICAL ERROR initializing Supabase: {e}")
+
+# Micro-batching: single-row webhook inserts are queued here and a background
+# coroutine flushes them in one insert per window, so co-arriving requests
+# cost one Supabase round trip instead of one each
+MICRO_BATCH_MAX_ROWS = 50
+MICRO_BATCH_WINDOW = 0.1  # seconds
+
+pending = asyncio.Queue()
+flusher_task = None
+
+# Delivery ids handled in the last hour - Typeform and Stripe retry on any
+# non-2xx and can replay deliveries; a repeat returns 200 without touching
+# Supabase. Everything runs on one event loop, so no lock is needed.
+seen_events = TTLCache(maxsize=10_000, ttl=3600)
+
+INSERT_MAX_RETRIES = 3
+
+async def upsert_clients(rows):
+    """
+    Upsert client rows with exponential backoff. Queued submissions were
+    already acked with 202, so a transient Supabase blip must not drop them.
+    """
+    delay = 0.5
+    for attempt in range(INSERT_MAX_RETRIES):
+        try:
+            return await supabase.table('clients').upsert(
+                rows, on_conflict='contact_email', ignore_duplicates=True
+            ).execute()
+        except Exception as e:
+            if attempt == INSERT_MAX_RETRIES - 1:
+                raise
+            logger.warning("upsert_retry attempt=%d error=%s", attempt + 1, e)
+            await asyncio.sleep(delay)
+            delay *= 2
+
+async def flush_pending():
+    """Coalesce queued client rows into a single insert every window."""
+    while True:
+        batch = []
+        try:
+            # Block until at least one row arrives, then collect whatever
+            # else shows up within the window (or until the batch is full)
+            batch.append(await pending.get())
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + MICRO_BATCH_WINDOW
+            while len(batch) < MICRO_BATCH_MAX_ROWS:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(pending.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                # upsert + ignore_duplicates = ON CONFLICT DO NOTHING at the
+                # DB layer, so replays that slip past the id cache still
+                # can't create duplicate rows
+                await upsert_clients(batch)
+                logger.info("batch_flushed rows=%d", len(batch))
+            except Exception as e:
+                logger.error("batch_flush_failed rows=%d error=%s", len(batch), e)
+        except asyncio.CancelledError:
+            # Cancelled mid-window or mid-write: hand collected rows back so
+            # the shutdown drain flushes them instead of losing them. A
+            # partially applied batch is safe to write again - the upsert
+            # ignores duplicates.
+            for row in batch:
+                pending.put_nowait(row)
+            raise
+
+async def get_supabase():
+    """
+    Return the shared async Supabase client, creating it on first use.
+
+    Lazy getter rather than import-time creation: importing this module
+    (unit tests, health-only probes, Gunicorn preload) never builds a
+    client, and every caller afterwards gets the same one. functools.cache
+    can't memoize a coroutine, so the module global plays that role.
+    """
+    global supabase
+    if supabase is not None:
+        return supabase
+    try:
+        if SUPABASE_URL and SUPABASE_SERVICE_KEY:
+            client = await acreate_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+            # Swap in a pooled HTTP/2 session so every insert/update reuses
+            # one warm connection instead of paying TLS setup (~60ms) per call
+            default_session = client.postgrest.session
+            client.postgrest.session = httpx.AsyncClient(
+                base_url=default_session.base_url,
+                headers=default_session.headers,
+                follow_redirects=True,  # the postgrest default it replaces sets this
+                http2=True,
+                limits=httpx.Limits(
+                    max_keepalive_connections=20,
+                    max_connections=50,
+                    keepalive_expiry=60,
+                ),
+                timeout=httpx.Timeout(10.0),
+            )
+            await default_session.aclose()
+            supabase = client
+            logger.info("supabase_initialized")
+        else:
+            logger.error("supabase_credentials_missing")
+    except Exception as e:
+        logger.critical("supabase_init_failed error=%s", e)
+    return supabase
+
+@app.before_serving
+async def startup():
+    """Warm the Supabase client and start the flusher before first request."""
+    if await get_supabase():
+        global flusher_task
+        flusher_task = asyncio.ensure_future(flush_pending())
+
+@app.after_serving
+async def stop_flusher():
+    """Stop the flusher and drain anything still queued before shutdown."""
+    if flusher_task:
+        flusher_task.cancel()
+        try:
+            await flusher_task
+        except asyncio.CancelledError:
+            pass
+
+    leftover = []
+    while not pending.empty():
+        leftover.append(pending.get_nowait())
+    if leftover and supabase:
+        try:
+            await upsert_clients(leftover)
+            logger.info("shutdown_flush rows=%d", len(leftover))
+        except Exception as e:
+            logger.error("shutdown_flush_failed rows=%d error=%s", len(leftover), e)
 
 @app.route('/')
-def home():
+async def home():
     """Health check endpoint - Typeform will ping this to verify webhook is alive."""
     return jsonify({
         'status': 'online',
@@ -32,15 +196,58 @@ def home():
     }), 200
 
 @app.route('/health')
-def health():
+async def health():
     """Alternative health check (some services prefer /health)."""
     return jsonify({'status': 'healthy'}), 200
 
+# Compiled once at import time into specialized validation bytecode - one
+# call checks the whole payload shape, rejecting malformed submissions with
+# 400 before any extraction or DB work instead of 500ing mid-handler
+_validate_typeform = fastjsonschema.compile({
+    'type': 'object',
+    'required': ['form_response'],
+    'properties': {
+        'form_response': {
+            'type': 'object',
+            'required': ['answers'],
+            'properties': {
+                'answers': {
+                    'type': 'array',
+                    'minItems': 4,
+                    'items': {'type': 'object'},
+                },
+            },
+        },
+    },
+})
+
+# Fallback values when a Typeform answer is missing its text/email field
+_DEFAULTS = ('Unknown Business', 'no-email@example.com', 'Not specified', 'Not specified')
+
+def build_client_data(answers):
+    """
+    Map a Typeform answers list to a clients-table row.
+    Returns None if the submission doesn't have enough answers.
+    """
+    if not answers or len(answers) < 4:
+        return None
+
+    # IMPORTANT: These indices match your Typeform question order
+    a0, a1, a2, a3 = answers[0], answers[1], answers[2], answers[3]
+    return {
+        'business_name': a0.get('text') or _DEFAULTS[0],
+        'contact_email': a1.get('email') or _DEFAULTS[1],
+        'prospecting_niche': a2.get('text') or _DEFAULTS[2],
+        'prospecting_location': a3.get('text') or _DEFAULTS[3],
+        'subscription_status': 'trialing',  # They start on a trial
+        'monthly_plan': 'pro'
+    }
+
 @app.route('/typeform-webhook', methods=['POST'])
-def handle_typeform_submission():
+async def handle_typeform_submission():
     """
     Receives Typeform submissions and saves client data to Supabase.
-    
+
     Expected payload from Typeform:
     {
         "form_response": {
@@ -55,113 +262,224 @@ def handle_typeform_submission():
     """
     try:
         # Log that we received a webhook (helps with debugging)
-        print("📥 Received Typeform webhook")
-        
+        logger.info("typeform_webhook_received")
+
         # Check if Supabase is connected
-        if not supabase:
-            print("❌ ERROR: Supabase not initialized")
+        if not await get_supabase():
+            logger.error("supabase_not_initialized")
             return jsonify({'error': 'Database connection failed'}), 500
-        
-        # Get the JSON data from Typeform
-        data = request.json
-        
+
+        # Get the JSON data from Typeform (cache=False: the body is parsed
+        # exactly once, no second copy kept on the request)
+        data = await request.get_json(cache=False)
+
         if not data:
-            print("❌ ERROR: No JSON data received")
+            logger.error("empty_payload")
             return jsonify({'error': 'No data received'}), 400
-        
-        # Extract answers from Typeform payload
-        answers = data.get('form_response', {}).get('answers', [])
-        
-        if len(answers) < 4:
-            print(f"❌ ERROR: Not enough answers (got {len(answers)}, need 4)")
+
+        # Short-circuit replayed deliveries before doing any real work
+        event_id = data.get('event_id')
+        if event_id and event_id in seen_events:
+            logger.info("duplicate_delivery event_id=%s", event_id)
+            return jsonify({'status': 'duplicate'}), 200
+
+        # One compiled-schema call replaces the chained .get() checks and
+        # rejects malformed payloads before any DB work
+        try:
+            _validate_typeform(data)
+        except fastjsonschema.JsonSchemaException as e:
+            logger.error("invalid_typeform_payload error=%s", e)
             return jsonify({'error': 'Incomplete form submission'}), 400
-        
-        # Map answers to database fields
-        # IMPORTANT: These indices match your Typeform question order
-        business_name = answers[0].get('text', 'Unknown Business')
-        contact_email = answers[1].get('email', 'no-email@example.com')
-        prospecting_niche = answers[2].get('text', 'Not specified')
-        prospecting_location = answers[3].get('text', 'Not specified')
-        
-        print(f"📝 Processing client: {business_name}")
-        
-        # Prepare data for Supabase
-        client_data = {
-            'business_name': business_name,
-            'contact_email': contact_email,
-            'prospecting_niche': prospecting_niche,
-            'prospecting_location': prospecting_location,
-            'subscription_status': 'trialing',  # They start on a trial
-            'monthly_plan': 'pro'
-        }
-        
-        # Save to Supabase
-        response = supabase.table('clients').insert(client_data).execute()
-        
-        print(f"✅ SUCCESS: Client '{business_name}' saved to database")
-        
+
+        client_data = build_client_data(data['form_response']['answers'])
+
+        business_name = client_data['business_name']
+        logger.info("processing_client name=%s", business_name)
+
+        # Synchronous fallback: ?sync=1 writes immediately and returns the
+        # row id - use this when the caller must know the insert happened
+        if request.args.get('sync') or not flusher_task:
+            response = await supabase.table('clients').upsert(
+                client_data, on_conflict='contact_email', ignore_duplicates=True
+            ).execute()
+            if event_id:
+                seen_events[event_id] = True
+            logger.info("client_saved name=%s", business_name)
+            return jsonify({
+                'status': 'success',
+                'message': f'Client {business_name} added successfully',
+                'client_id': response.data[0]['id'] if response.data else None
+            }), 200
+
+        # Default path: queue for the micro-batch flusher and ack with 202 -
+        # Typeform only needs a fast 2xx, so webhook latency is decoupled
+        # from Supabase latency entirely
+        await pending.put(client_data)
+        if event_id:
+            seen_events[event_id] = True
+
+        logger.info("client_queued name=%s", business_name)
+
+        return jsonify({
+            'status': 'accepted',
+            'message': f'Client {business_name} queued successfully'
+        }), 202
+
+    except HTTPException:
+        # Framework errors (413 from the body cap, etc.) must keep their
+        # status - a blanket 500 would make Typeform retry the bad request
+        raise
+    except Exception as e:
+        logger.error("typeform_webhook_failed error=%s", e)
+        # Full stacks only in debug - formatting one per request burns CPU
+        # if a misbehaving client loops on an error path
+        if app.debug:
+            logger.error("%s", traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/typeform-webhook/batch', methods=['POST'])
+async def handle_typeform_batch():
+    """
+    Bulk version of /typeform-webhook for retry storms and imports.
+
+    Accepts either a JSON array of Typeform payloads, or JSON Lines
+    (Content-Type: application/jsonl, one payload per line). All rows go
+    to Supabase in a single insert - one network round trip for N
+    submissions instead of N.
+    """
+    try:
+        logger.info("typeform_batch_received")
+
+        if not await get_supabase():
+            logger.error("supabase_not_initialized")
+            return jsonify({'error': 'Database connection failed'}), 500
+
+        if request.content_type and 'jsonl' in request.content_type:
+            body = await request.get_data()
+            payloads = [orjson.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            payloads = await request.get_json(cache=False)
+
+        if not isinstance(payloads, list) or not payloads:
+            logger.error("invalid_batch_body")
+            return jsonify({'error': 'Expected a non-empty batch of submissions'}), 400
+
+        rows = []
+        skipped = 0
+        for payload in payloads:
+            try:
+                _validate_typeform(payload)
+            except fastjsonschema.JsonSchemaException:
+                skipped += 1
+                continue
+            rows.append(build_client_data(payload['form_response']['answers']))
+
+        if not rows:
+            logger.error("empty_batch")
+            return jsonify({'error': 'No valid submissions in batch'}), 400
+
+        logger.info("inserting_batch rows=%d skipped=%d", len(rows), skipped)
+
+        # One insert, one SQL statement - PostgREST handles the array natively
+        await supabase.table('clients').upsert(
+            rows, on_conflict='contact_email', ignore_duplicates=True
+        ).execute()
+
+        logger.info("batch_saved rows=%d", len(rows))
+
         return jsonify({
             'status': 'success',
-            'message': f'Client {business_name} added successfully',
-            'client_id': response.data[0]['id'] if response.data else None
+            'inserted': len(rows),
+            'skipped': skipped
         }), 200
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ ERROR processing Typeform webhook: {e}")
-        import traceback
-        print(traceback.format_exc())
+        logger.error("typeform_batch_failed error=%s", e)
+        if app.debug:
+            logger.error("%s", traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
 @app.route('/stripe-webhook', methods=['POST'])
-def handle_stripe_payment():
+async def handle_stripe_payment():
     """
     Receives Stripe payment confirmations.
     When a client pays, update their subscription_status to 'active'.
-    
-    TODO: Add Stripe webhook signature verification for security.
+
+    Requires a valid Stripe-Signature header (set STRIPE_WEBHOOK_SECRET);
+    spoofed payloads are rejected before any JSON parse or Supabase call.
     """
     try:
-        print("💳 Received Stripe webhook")
-        
-        if not supabase:
+        logger.info("stripe_webhook_received")
+
+        if not await get_supabase():
+            logger.error("supabase_not_initialized")
             return jsonify({'error': 'Database connection failed'}), 500
-        
-        data = request.json
+
+        payload = await request.get_data()
+
+        # Verify the signature (constant-time HMAC, ~1µs) before spending
+        # anything on parsing or the database. The tolerance bounds the
+        # signed timestamp to ±300s, so a captured payload can't be
+        # replayed after the seen_events TTL expires
+        if STRIPE_WEBHOOK_SECRET:
+            sig_header = request.headers.get('Stripe-Signature')
+            try:
+                stripe.WebhookSignature.verify_header(
+                    payload.decode('utf-8'), sig_header, STRIPE_WEBHOOK_SECRET,
+                    tolerance=stripe.Webhook.DEFAULT_TOLERANCE
+                )
+            except (stripe.SignatureVerificationError, ValueError, AttributeError):
+                logger.error("invalid_stripe_signature")
+                return jsonify({'error': 'Invalid signature'}), 400
+        else:
+            logger.warning("stripe_signature_verification_skipped")
+
+        data = orjson.loads(payload)
+
+        # Short-circuit replayed deliveries (Stripe retries on non-2xx)
+        event_id = data.get('id')
+        if event_id and event_id in seen_events:
+            logger.info("duplicate_delivery event_id=%s", event_id)
+            return jsonify({'status': 'duplicate'}), 200
+
         event_type = data.get('type')
-        
-        print(f"📋 Stripe event type: {event_type}")
-        
+
+        logger.info("stripe_event type=%s", event_type)
+
         # Handle successful checkout
         if event_type == 'checkout.session.completed':
             customer_email = data.get('data', {}).get('object', {}).get('customer_details', {}).get('email')
-            
+
             if customer_email:
-                print(f"🔄 Activating client: {customer_email}")
-                
+                logger.info("activating_client email=%s", customer_email)
+
                 # Update client status to 'active'
-                supabase.table('clients').update({
+                await supabase.table('clients').update({
                     'subscription_status': 'active'
                 }).eq('contact_email', customer_email).execute()
-                
-                print(f"✅ Client {customer_email} activated successfully")
-        
+
+                logger.info("client_activated email=%s", customer_email)
+
+        if event_id:
+            seen_events[event_id] = True
+
         return jsonify({'status': 'success'}), 200
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ ERROR processing Stripe webhook: {e}")
+        logger.error("stripe_webhook_failed error=%s", e)
         return jsonify({'error': str(e)}), 500
 
-# This is required for Gunicorn (production server)
+# In production this app is served by Uvicorn (see Procfile)
 if __name__ == '__main__':
     # Get port from environment (Koyeb sets this automatically)
     port = int(os.getenv('PORT', 5000))
-    
-    print(f"🚀 Starting CallFlex AI Webhook Server on port {port}")
-    print(f"🔗 Webhook endpoints:")
-    print(f"   - Typeform: https://your-domain.koyeb.app/typeform-webhook")
-    print(f"   - Stripe: https://your-domain.koyeb.app/stripe-webhook")
-    print(f"   - Health check: https://your-domain.koyeb.app/health")
-    
-    # Run Flask app
+
+    logger.info("server_starting port=%d", port)
+
+    # Run Quart's local dev server
     # debug=False for production, True for local testing
     app.run(host='0.0.0.0', port=port, debug=False)